@@ -26,7 +26,7 @@ def compute_area(feature, projection=None):
     """
     if projection:
         if projection == 1:
-            centroid = shapely.geometry.asShape(feature['geometry']).centroid
+            centroid = shapely.geometry.shape(feature['geometry']).centroid
             lon, lat = centroid.x, centroid.y
             epsg_code = projections.get_utm_code(lat, lon)
         else:
@@ -35,7 +35,7 @@ def compute_area(feature, projection=None):
     else:
         projected_geom = feature['geometry']
 
-    polygon = shapely.geometry.asShape(projected_geom)
+    polygon = shapely.geometry.shape(projected_geom)
     return polygon.area
 
 def compute_areas(feature_collection_fname, projection=None, overwrite=True):
@@ -69,14 +69,19 @@ def compute_areas(feature_collection_fname, projection=None, overwrite=True):
 
 def _project(geom, epsg_code=None):
     """Project each geographic coordinate of input geom."""
-    projected_geom = json.loads(json.dumps(geom))
-    for i, component in enumerate(geom['coordinates']):
-        for j, point in enumerate(component):
-            lon, lat = point[:2]
-            easting, northing = projections.project_to_utm(lat, lon,
-                                                           epsg_code=epsg_code)
-            projected_geom['coordinates'][i][j] = [easting, northing]
+    projected_geom = dict(geom)
+    projected_geom['coordinates'] = [
+        [_project_point(point, epsg_code) for point in component]
+        for component in geom['coordinates']
+    ]
     return projected_geom
+
+def _project_point(point, epsg_code):
+    """Project a [lon, lat, ...] point to [easting, northing]."""
+    lon, lat = point[:2]
+    easting, northing = projections.project_to_utm(lat, lon,
+                                                   epsg_code=epsg_code)
+    return [easting, northing]
                     
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
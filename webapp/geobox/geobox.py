@@ -58,6 +58,31 @@ def bbox_from_geometries(geoms):
     union = unary_union([geometry.shape(g) for g in geoms])
     return geometry.box(*union.bounds)
     
+def bounds_overlap_area(bounds, other):
+    """Compute the area shared by two bounding rectangles.
+
+    Arguments: 
+        bounds, other: Rectangles as (minx, miny, maxx, maxy), e.g. the
+            bounds of shapely geometries
+
+    Returns: Area of the rectangles' intersection, zero if disjoint.
+    """
+    width = min(bounds[2], other[2]) - max(bounds[0], other[0])
+    height = min(bounds[3], other[3]) - max(bounds[1], other[1])
+    return max(width, 0) * max(height, 0)
+
+def bounds_contain(bounds, other):
+    """Check whether one bounding rectangle lies within another.
+
+    Arguments: 
+        bounds, other: Rectangles as (minx, miny, maxx, maxy), e.g. the
+            bounds of shapely geometries
+
+    Returns: True if other lies within bounds.
+    """
+    return (bounds[0] <= other[0] and bounds[1] <= other[1] and
+            other[2] <= bounds[2] and other[3] <= bounds[3])
+
 def osm_to_shapely_box(osm_bbox):
     """Convert a bounding box in OSM convention to a shapely box.
 
@@ -8,14 +8,22 @@ dg.DGImageGrabber and planet_grabber.PlanetGrabber.
  
 from abc import ABC, abstractmethod
 import asyncio
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-from itertools import islice
+from functools import lru_cache
 import json
+import math
 import os
 import sys
+import threading
+import time
+from types import MappingProxyType
 
 import dateutil
+import shapely.geometry
 import shapely.ops
+import shapely.prepared
 
 import cloud_storage
 from geobox import geobox
@@ -28,6 +36,67 @@ SPECS_FILE = os.path.join(os.path.dirname(__file__), 'default_specs.json')
 
 STAGING_DIR = os.path.join(os.path.dirname(__file__), 'tmp-staging')
 
+# Search results are held briefly so that repeated searches over the same
+# bbox skip the catalog round trip. Times in seconds:
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_MAXSIZE = 256
+# A search whose endDate is more than SETTLED_DAYS past can no longer
+# acquire new records, so its results are held longer:
+SETTLED_DAYS = 7
+SETTLED_SEARCH_CACHE_TTL = 7 * 24 * 3600
+
+# The service builds a fresh grabber for each request, so search results
+# are held for the process, keyed by provider, and shared across grabbers:
+_search_cache = {}
+_search_cache_lock = threading.Lock()
+
+# Image data transfers run concurrently up to this limit, while activation
+# and reprocessing of other scenes proceed alongside:
+MAX_CONCURRENT_DOWNLOADS = 4
+
+# Cap on overlaps remembered for the current bbox:
+OVERLAP_CACHE_MAXSIZE = 1024
+
+@lru_cache(maxsize=16)
+def _parse_specs(specs_filename, mtime):
+    """Parse a specs file, once per file modification time."""
+    with open(specs_filename, 'r') as f:
+        return MappingProxyType(json.load(f))
+
+def load_specs(specs_filename=SPECS_FILE):
+    """Return the specs parsed from specs_filename.
+
+    The mapping is shared and read-only; its list values must not be
+    mutated in place.
+    """
+    mtime = os.path.getmtime(specs_filename)
+    return _parse_specs(specs_filename, mtime)
+
+def parse_date(timestamp):
+    """Extract the date from an ISO 8601 timestamp string.
+
+    Catalog timestamps begin YYYY-MM-DD, which is read directly; other
+    formats fall back to dateutil.
+
+    Returns: A datetime.date object
+    """
+    try:
+        return datetime.date.fromisoformat(timestamp[:10])
+    except ValueError:
+        return dateutil.parser.parse(timestamp).date()
+
+def use_uvloop():
+    """Set uvloop's event loop policy, where uvloop is available.
+
+    uvloop provides a faster event loop for grabbers. The policy is
+    process-wide, so it is set by entry points rather than on import.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 def loop(function):
     """Scheduling wrapper for async execution."""
     def scheduled(*args, **kwargs):
@@ -43,7 +112,8 @@ class ImageGrabber(ABC):
         client: Satellite provider API instantiated interface  
         bucket_tool: Class instance to access cloud storage bucket, or 
             None to save images locally
-        specs: Dict of catalog and image specs
+        specs: Mapping of catalog and image specs
+        download_limit: Cap on image data transfers at once
 
     Template external methods:
         __call__: Wrapper for async execution of pull().
@@ -54,8 +124,10 @@ class ImageGrabber(ABC):
         search_clean: Search and return streamlined image records.
         search_latlon_clean:  Search and return streamlined image records.
         search_id_clean: Retrieve record for input catalogID.
+        cache_clear: Clear cached search results.
         photoshop: Convert a raw GeoTiff into visual and data products.
     """
+    download_limit = MAX_CONCURRENT_DOWNLOADS
 
     def __init__(self, client, bucket='bespoke-images',
                  staging_dir=STAGING_DIR, specs_filename=SPECS_FILE, **specs):
@@ -70,15 +142,19 @@ class ImageGrabber(ABC):
         else:
             self.bucket_tool = None
 
-        with open(specs_filename, 'r') as f:
-            self.specs = json.load(f)
-        self.specs.update(specs)
+        # Writes go to the first map, leaving the shared defaults intact:
+        self.specs = ChainMap({}, specs, load_specs(specs_filename))
         if not os.path.exists(staging_dir):
             os.makedirs(staging_dir)
         self.specs.update({
             'file_header':
                 os.path.join(staging_dir, self.specs.get('file_header', ''))
         })
+        self._download_semaphore = None
+        self._prepared_bbox = (None, None, None, None)
+        # Scenes are mosaicked in concurrent threads, which share the
+        # prepared bbox and overlap memo:
+        self._overlap_lock = threading.Lock()
 
         
     # Top level image grabbing functions
@@ -105,7 +181,7 @@ class ImageGrabber(ABC):
 
         Argument *args: For Planet, an item_type
         """
-        records = iter([self._search_id(catalogID, *args)])
+        records = iter([self._cached_search_id(catalogID, *args)])
         try: 
             scene = next(iter(self._compile_scenes(records, bbox)))
         except StopIteration:
@@ -116,6 +192,28 @@ class ImageGrabber(ABC):
     async def grab_scene(self, scene, bbox):
         """Activate, download, and process scene assets."""
         paths = await self._download(scene, bbox)
+        loop = asyncio.get_running_loop()
+        record = await loop.run_in_executor(
+            None, self._process_scene, paths, scene, bbox)
+        return record
+
+    def _download_slot(self):
+        """Get the semaphore to hold while transferring image data.
+
+        It is held around the byte transfer only, so that scenes waiting
+        on activation do not take up the download limit.
+
+        Returns: An asyncio.Semaphore of size download_limit
+        """
+        if self._download_semaphore is None:
+            self._download_semaphore = asyncio.Semaphore(self.download_limit)
+        return self._download_semaphore
+
+    def _process_scene(self, paths, scene, bbox):
+        """Mosaic, color, and store downloaded scene assets.
+
+        Returns: Cleaned scene record with urls or paths to the images.
+        """
         merged_path, record = self._mosaic(paths, scene, bbox)
         output_paths = self.photoshop(merged_path)
         if self.specs['thumbnails']:
@@ -154,34 +252,97 @@ class ImageGrabber(ABC):
         return scenes
     
     @abstractmethod   
-    def _search(self):
+    def _search(self, bbox, max_records=None):
         pass
 
     @abstractmethod
     def _search_id(self):
         pass
 
-    def _search_latlon(self, lat, lon, epsilon=.001):
-        """Search catalog for images containing lat, lon.
+    def _latlon_box(self, lat, lon, epsilon=.001):
+        """Make a small box for catalog search of images containing lat, lon.
 
         Argument epsilon: Scale in km for a small box around lat, lon.
         """
-        minibox = geobox.bbox_from_scale(lat, lon, epsilon)
-        return self._search(minibox)
+        return geobox.bbox_from_scale(lat, lon, epsilon)
     
     def search_clean(self, bbox, max_records=None):
         """Search the catalog and return streamlined records."""
-        records = self._search(bbox)
-        return [self._clean(r) for r in islice(records, max_records)]
+        records = self._cached_search(bbox, max_records)
+        return [self._clean(r) for r in records]
     
     def search_latlon_clean(self, lat, lon, max_records=None):
         """Search the catalog and return streamlined records."""
-        records = self._search_latlon(lat, lon)
-        return [self._clean(r) for r in islice(records, max_records)]
+        minibox = self._latlon_box(lat, lon)
+        return self.search_clean(minibox, max_records=max_records)
+
+    def _cached_search(self, bbox, max_records=None):
+        """Search the catalog, reusing recent results for the same bbox.
+
+        Results are keyed on the provider, bbox, max_records and the
+        current specs, so a change in specs triggers a fresh search.
+
+        Returns: List of up to max_records image records.
+        """
+        key = (bbox.wkb, max_records,
+               json.dumps(dict(self.specs), sort_keys=True, default=str))
+        return self._memo(
+            key, self._search_cache_ttl(),
+            lambda: list(self._search(bbox, max_records=max_records)))
+
+    def _cached_search_id(self, catalogID, *args):
+        """Retrieve record for input catalogID, reusing a recent result."""
+        key = ('id', catalogID) + args
+        return self._memo(key, SEARCH_CACHE_TTL,
+                          lambda: self._search_id(catalogID, *args))
+
+    def _memo(self, key, ttl, fetch):
+        """Return the cached value for key, or fetch and cache it.
+
+        Values are held in the module-level search cache, under key
+        prefixed by the grabber's class.
+
+        Arguments:
+            key: Hashable cache key
+            ttl: Seconds for which a fetched value remains valid
+            fetch: Function of no arguments that returns the value
+
+        Returns: The cached or freshly fetched value.
+        """
+        key = (type(self).__name__,) + key
+        now = time.time()
+        cached = _search_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        value = fetch()
+        with _search_cache_lock:
+            if len(_search_cache) >= SEARCH_CACHE_MAXSIZE:
+                for k in [k for k,v in _search_cache.items() if v[0] <= now]:
+                    del _search_cache[k]
+            if len(_search_cache) >= SEARCH_CACHE_MAXSIZE:
+                _search_cache.pop(next(iter(_search_cache)))
+            _search_cache[key] = (now + ttl, value)
+        return value
+
+    def _search_cache_ttl(self):
+        """Determine how long search results remain valid, in seconds."""
+        if self.specs.get('endDate'):
+            end = parse_date(self.specs['endDate'])
+            if (datetime.date.today() - end).days > SETTLED_DAYS:
+                return SETTLED_SEARCH_CACHE_TTL
+        return SEARCH_CACHE_TTL
+
+    def cache_clear(self):
+        """Clear cached search results for this grabber's provider."""
+        provider = type(self).__name__
+        with _search_cache_lock:
+            for k in [k for k in _search_cache if k[0] == provider]:
+                del _search_cache[k]
 
     def search_id_clean(self, catalogID, *args):
         """Retrieve record for input catalogID."""
-        record = self._search_id(catalogID, *args)
+        record = self._cached_search_id(catalogID, *args)
         return self._clean(record)
 
     @abstractmethod
@@ -193,14 +354,89 @@ class ImageGrabber(ABC):
     def _compile_scenes(self):
         pass
 
-    def _get_overlap(self, bbox, *records):
+    def _get_overlap(self, bbox, *records, min_frac=0):
         """Find geographic intersection between bbox and records.
 
+        Exact results are remembered for the current bbox, so a group's
+        overlap found while filtering is reused when it is mosaicked.
+
+        Argument min_frac: Optional fractional area below which the exact
+            intersection is not needed. If the overlap of bounding 
+            rectangles already falls short, an empty shape is returned
+            along with that upper bound on the fractional area.
+
         Returns: A Shapely shape and fractional area relative to bbox.
         """
-        footprints = [self._read_footprint(r) for r in records]
-        overlap = bbox.intersection(shapely.ops.unary_union(footprints))
-        return overlap, overlap.area/bbox.area
+        all_footprints = tuple(self._footprint(r) for r in records)
+        # Footprints are held in the cached value, so their ids stay unique:
+        key = tuple(id(f) for f in all_footprints)
+        with self._overlap_lock:
+            prepared, bbox_area, overlaps = self._prepare(bbox)
+            hit = overlaps.get(key)
+        if hit:
+            return hit[1]
+
+        # Footprints whose bounding rectangles miss bbox contribute no area,
+        # and are dropped before any geometric operations:
+        footprints, bound, bbox_bounds = [], 0, bbox.bounds
+        for footprint in all_footprints:
+            area = geobox.bounds_overlap_area(bbox_bounds, footprint.bounds)
+            if area > 0:
+                footprints.append(footprint)
+                bound += area
+        bound /= bbox_area
+        if footprints and bound < min_frac:
+            return shapely.geometry.GeometryCollection(), bound
+
+        if not footprints:
+            result = shapely.geometry.GeometryCollection(), 0.0
+        else:
+            if len(footprints) == 1:
+                union = footprints[0]
+            else:
+                union = shapely.ops.unary_union(footprints)
+            # Settle the disjoint and fully covered cases without computing
+            # the intersection:
+            union_bounds = union.bounds
+            # GEOS prepared geometries are not safe for concurrent use:
+            with self._overlap_lock:
+                disjoint = not prepared.intersects(union)
+            if disjoint:
+                result = shapely.geometry.GeometryCollection(), 0.0
+            elif (geobox.bounds_contain(bbox_bounds, union_bounds) and
+                  math.isclose(bbox_area, geobox.bounds_overlap_area(
+                      bbox_bounds, bbox_bounds))):
+                # A rectangular bbox holds the whole union:
+                result = union, union.area/bbox_area
+            elif (geobox.bounds_contain(union_bounds, bbox_bounds) and
+                  union.contains(bbox)):
+                result = bbox, 1.0
+            else:
+                overlap = bbox.intersection(union)
+                result = overlap, overlap.area/bbox_area
+
+        with self._overlap_lock:
+            if len(overlaps) >= OVERLAP_CACHE_MAXSIZE:
+                overlaps.clear()
+            overlaps[key] = (all_footprints, result)
+        return result
+
+    def _prepare(self, bbox):
+        """Get a prepared geometry, area, and overlap memo for bbox.
+
+        Overlaps are computed many times against the same bbox while
+        filtering, sorting and mosaicking records, so the most recent
+        bbox is kept. Call with self._overlap_lock held.
+
+        Returns: A Shapely prepared geometry, the bbox area, and a dict
+            of overlaps found so far.
+        """
+        cached, prepared, area, overlaps = self._prepared_bbox
+        if cached is not bbox:
+            prepared, area, overlaps = (
+                shapely.prepared.prep(bbox), bbox.area, {})
+            self._prepared_bbox = (bbox, prepared, area, overlaps)
+        return prepared, area, overlaps
 
     def _well_overlapped(self, frac_area, *IDs):
         """Check whether fractional area meets specs.
@@ -217,10 +453,30 @@ class ImageGrabber(ABC):
                 'Overlap with bbox {:.1%}'.format(frac_area), flush=True)
         return well_o
 
+    def _footprint(self, record):
+        """Get a record's footprint, parsing it only once per record."""
+        try:
+            return record['_footprint']
+        except KeyError:
+            footprint = record['_footprint'] = self._read_footprint(record)
+            return footprint
+
     @abstractmethod
     def _read_footprint(self):
         pass
 
+    def _date(self, record):
+        """Get a record's acquisition date, parsing it once per record."""
+        try:
+            return record['_date']
+        except KeyError:
+            date = record['_date'] = parse_date(self._read_timestamp(record))
+            return date
+
+    @abstractmethod
+    def _read_timestamp(self):
+        pass
+
     def _fastforward(self, records, date):
         """Advance to a record older than date by self.specs['skip_days'].
 
@@ -231,8 +487,7 @@ class ImageGrabber(ABC):
         Returns: An image record, or None
         """
         for record in records:
-            cleaned = self._clean(record)
-            date_aq = dateutil.parser.parse(cleaned['timestamp']).date()
+            date_aq = self._date(record)
             if (date - date_aq).days > self.specs['skip_days']:
                 return record
 
@@ -258,10 +513,20 @@ class ImageGrabber(ABC):
     def photoshop(self, path):
         """Convert a raw GeoTiff into visual and data products."""
         output_paths = []
-        if self.specs['landcover_indices']:
+        if not self.specs['landcover_indices']:
+            output_paths += self._coloring(path)
+        else:
             output_paths += self._indexing(path)
-            path = gdal_routines.reband(path, [1, 2, 3])
-        output_paths += self._coloring(path)
+            # Coloring reads the R-G-B bands of the raw GeoTiff directly.
+            # If an R-G-B GeoTiff is to be kept, it is written alongside.
+            if self.specs['thumbnails'] and output_paths:
+                output_paths += self._coloring(path, bands=[1, 2, 3])
+            else:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    rebanded = executor.submit(
+                        gdal_routines.reband, path, [1, 2, 3], clean=False)
+                    output_paths += self._coloring(path, bands=[1, 2, 3])
+                os.replace(rebanded.result(), path)
 
         if self.specs['thumbnails'] and output_paths:
             os.remove(path)
@@ -274,25 +539,30 @@ class ImageGrabber(ABC):
 
         Returns: Paths to grayscale images.
         """
+        indices = self.specs['landcover_indices']
         output_paths = []
-        for index in self.specs['landcover_indices']:
-            try:
-                output_paths.append(landcover.compute_index(path, index))
-            except ValueError as e:
-                print('{}: {}. Continuing.'.format(repr(e), index), flush=True)
+        for index, result in zip(indices,
+                                 landcover.compute_indices(path, indices)):
+            if isinstance(result, ValueError):
+                print('{}: {}. Continuing.'.format(repr(result), index),
+                      flush=True)
+            else:
+                output_paths.append(result)
         return output_paths
     
-    def _coloring(self, path):
+    def _coloring(self, path, bands=None):
         """Produce styles of visual images.
 
+        Argument bands: Optional R-G-B band numbers to read from path
+
         Returns: Paths to color-corrected images.
         """
-        output_paths = []
+        styles = []
         for style in self.specs['write_styles']:
             if style in color.STYLES:
-                output_paths.append(color.ColorCorrect(style=style)(path))
+                styles.append(style)
             else:
                 print('Style <{}> not recognized.'.format(style), flush=True)
-        return output_paths
+        return color.correct_styles(path, styles, bands=bands)
 
     
@@ -57,7 +57,10 @@ The latter two have resolution roughly half that and we decomissioned in 2015.
 """
 
 import asyncio
+from functools import lru_cache
+import heapq
 import os
+from types import MappingProxyType
 
 import dateutil
 import numpy as np
@@ -69,18 +72,19 @@ from rasterio.enums import ColorInterp
 from grabbers import base 
 from geobox import geobox
 from geobox import projections
+from postprocessing import color
 
 KNOWN_IMAGE_SOURCES = ['WORLDVIEW02', 'WORLDVIEW03_VNIR', 'GEOEYE01',
                       'QUICKBIRD02', 'IKONOS']
 
 # DG band numbers for R-G-B-NIR bands. Keys are the total number of bands.
-BANDMAP = {
+BANDMAP = MappingProxyType({
     '4': [2, 1, 0, 3],
     '8': [4, 2, 1, 6]
-}
+})
 
 # To standardize image records:
-KEYMAP = {  
+KEYMAP = MappingProxyType({
     'vendor': 'provider',
     'sensorPlatformName': 'sensor',
     'catalogID': 'catalogID',
@@ -89,7 +93,26 @@ KEYMAP = {
     'panResolution': 'resolution',
     'browseURL': 'thumbnail',
     'geometry': 'footprintWkt'
-}
+})
+
+@lru_cache(maxsize=64)
+def _cached_search_filters(image_source, clouds, offNadirAngle):
+    """Build catalog search filters, shared by grabbers with equal specs.
+
+    Arguments:
+        image_source: Tuple of sensor platform names
+        clouds: Maximum allowed percentage cloud cover
+        offNadirAngle: Optional (relation, angle) tuple
+
+    Returns: Tuple of filters, which must not be mutated.
+    """
+    sensors = ("(" + " OR ".join(["sensorPlatformName = '{}'".format(
+        source) for source in image_source]) + ")")
+    filters = [sensors]
+    filters.append('cloudCover < {:d}'.format(int(clouds)))
+    if offNadirAngle:
+        filters.append('offNadirAngle {} {}'.format(*offNadirAngle))
+    return tuple(filters)
     
 class DGImageGrabber(base.ImageGrabber):
     """Tool to pull DigitalGlobe imagery.
@@ -103,8 +126,6 @@ class DGImageGrabber(base.ImageGrabber):
         super().__init__(client, **kwargs)
         self._enforce_date_format()
         self._search_filters = self._build_search_filters()
-        self._bandmap = BANDMAP.copy()
-        self._keymap = KEYMAP.copy()
 
     # Initializations to DG requirments:
 
@@ -122,29 +143,30 @@ class DGImageGrabber(base.ImageGrabber):
                 
     def _build_search_filters(self):
         """Build filters to search catalog."""
-        sensors = ("(" + " OR ".join(["sensorPlatformName = '{}'".format(
-            source) for source in self.specs['image_source']]) + ")")
-        filters = [sensors]
-        filters.append('cloudCover < {:d}'.format(int(self.specs['clouds'])))
-        if self.specs['offNadirAngle']:
-            filters.append('offNadirAngle {} {}'.format(
-                self.specs['offNadirAngle']))
-        return filters
+        offNadirAngle = self.specs['offNadirAngle']
+        return _cached_search_filters(
+            tuple(self.specs['image_source']), self.specs['clouds'],
+            tuple(offNadirAngle) if offNadirAngle else None)
 
 
     # Search and scene preparation.
     
-    def _search(self, bbox):
+    def _search(self, bbox, max_records=None):
         """Search the catalog for relevant imagery.
 
+        Argument max_records: Optional limit on the number of records
+
         Returns: An iterator over image records.
         """
         records = self.client.search(
             searchAreaWkt=bbox.wkt, filters=self._search_filters,
             startDate=self.specs['startDate'],
             endDate=self.specs['endDate'])
-        records.sort(key=lambda r: r['properties']['timestamp'], reverse=True)
         print('Search found {} records.'.format(len(records)), flush=True) 
+        timestamp = lambda r: r['properties']['timestamp']
+        if max_records is not None:
+            return iter(heapq.nlargest(max_records, records, key=timestamp))
+        records.sort(key=timestamp, reverse=True)
         return iter(records)
 
     def _search_id(self, catalogID, *args):
@@ -153,8 +175,9 @@ class DGImageGrabber(base.ImageGrabber):
             
     def _clean(self, record):
         """Streamline image record."""
-        cleaned = {self._keymap[k]:v for k,v in record['properties'].items()
-                   if k in self._keymap}
+        properties = record['properties']
+        cleaned = {v:properties[k] for k,v in KEYMAP.items()
+                   if k in properties}
         return cleaned
 
     def _compile_scenes(self, records, bbox):
@@ -175,7 +198,8 @@ class DGImageGrabber(base.ImageGrabber):
         record = next(records, None)
         while record and len(scenes) < self.specs['N_images']:
             ID, date = record['identifier'], record['properties']['timestamp']
-            overlap, frac_area = self._get_overlap(bbox, record)
+            overlap, frac_area = self._get_overlap(
+                bbox, record, min_frac=self.specs['min_intersect'])
             if self._well_overlapped(frac_area, ID):
                 print('Trying ID {}: {}'.format(ID, date))
                 try:
@@ -190,7 +214,7 @@ class DGImageGrabber(base.ImageGrabber):
                 scenes.append([record])
                 if self.specs.get('skip_days'):
                     record = self._fastforward(
-                        records, dateutil.parser.parse(date).date())
+                        records, self._date(record))
                     continue
             record = next(records, None)
 
@@ -210,6 +234,10 @@ class DGImageGrabber(base.ImageGrabber):
         """Extract footprint in record as a shapely shape."""  
         return shapely.wkt.loads(record['properties']['footprintWkt'])
 
+    def _read_timestamp(self, record):
+        """Extract acquisition timestamp from record."""
+        return record['properties']['timestamp']
+
             
     # Scene download
 
@@ -222,13 +250,15 @@ class DGImageGrabber(base.ImageGrabber):
         """
         record = next(iter(scene))
         daskimg = record['daskimg']
-        bands = self._bandmap[str(daskimg.shape[0])]
+        bands = BANDMAP[str(daskimg.shape[0])]
         if not self.specs['landcover_indices']:
             bands = bands[:3]
 
         path = self._build_filename(bbox, record)
-        print('\nStaging at {}\n'.format(path), flush=True)
-        daskimg.geotiff(path=path, bands=bands, dtype='uint16', **self.specs)
+        async with self._download_slot():
+            print('\nStaging at {}\n'.format(path), flush=True)
+            daskimg.geotiff(path=path, bands=bands, dtype='uint16',
+                            **self.specs)
         self._ensure_image_format(path)
 
         return [path]
@@ -249,25 +279,29 @@ class DGImageGrabber(base.ImageGrabber):
         when the file is created. This routine overwrites the input file
         to handle these two file formatting issues. (Factoring the two 
         operations would require reading and rewriting the file twice.)
+        The image is copied block by block into a temporary file that then
+        replaces the input, so memory use stays flat for large images.
         """
-        with rasterio.open(path, 'r') as f:
-            profile = f.profile
-            img = f.read()
-
-        profile.update({'dtype': 'uint16'})
-        if profile['count'] == 3:
-            profile.update({'photometric': 'RGB'})
-        with rasterio.open(path, 'w', **profile) as f:
-            f.write(img.astype('uint16'))
+        rewritten = path.split('.tif')[0] + '-uint16.tif'
+        with rasterio.open(path, 'r') as src:
+            profile = src.profile.copy()
+            profile.update({'dtype': 'uint16'})
+            if profile['count'] == 3:
+                profile.update({'photometric': 'RGB'})
+            with rasterio.open(rewritten, 'w', **profile) as dst:
+                for _, window in src.block_windows(1):
+                    dst.write(src.read(window=window).astype('uint16'),
+                              window=window)
+        os.replace(rewritten, path)
             
         
     # Reprocessing
     
-    def _coloring(self, path):
+    def _coloring(self, path, bands=None):
         """Produce styles of visual images, with added histogram adjustment."""
         if self.specs['write_styles']:
             reg = self._regularize_histogram(path)
-            output_paths = super()._coloring(reg)
+            output_paths = super()._coloring(reg, bands=bands)
             os.remove(reg)
         else:
             output_paths = []
@@ -292,14 +326,16 @@ class DGImageGrabber(base.ImageGrabber):
         with rasterio.open(geotiff) as f:
             profile = f.profile
             img = f.read()
-            
-        coarsed = []
-        for band in img:
-            cut = np.percentile(band[np.where(band > 0)], percentile)
-            coarsed.append((band / cut) * target_value)
+
+        # One float32 buffer is scaled band by band and cast once:
+        cuts = [color.nonzero_percentiles(band, [percentile])[0]
+                for band in img]
+        coarsed = img.astype('float32')
+        coarsed *= (target_value / np.array(cuts, dtype='float32')).reshape(
+            -1, 1, 1)
 
         outfile = '.'.join(geotiff.split('.')[:-1]) + 'reg.tif'
         with rasterio.open(outfile, 'w', **profile) as f:
-            f.write(np.array(coarsed, dtype=profile['dtype']))
+            f.write(coarsed.astype(profile['dtype'], copy=False))
 
         return outfile
@@ -24,7 +24,6 @@ import os
 import aiohttp
 import dateutil
 import numpy as np
-import skimage
 
 from geobox import geobox
 from postprocessing import color
@@ -32,6 +31,9 @@ from postprocessing import color
 DEFAULT_SPECS_FILE = os.path.join(os.path.dirname(__file__),
                                   'default_specs.json')
 
+# Cap on simultaneous connections from one pull to the web app:
+CONNECTION_LIMIT = 16
+
 class LandsatThumbnails(object):
     """Pull Landsat thumbnails from the earthrise-assets web app.
 
@@ -68,18 +70,18 @@ class LandsatThumbnails(object):
         Returns: List of records of written images
         """
         scenes = self.prep_scenes(bbox)
-        grab_tasks = [
-            asyncio.ensure_future(self.grab_scene(bbox, scene))
-            for scene in scenes
-        ]
-
-        done, _ = await asyncio.wait(grab_tasks)
+        connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            grab_tasks = [self.grab_scene(bbox, scene, session=session)
+                          for scene in scenes]
+            results = await asyncio.gather(*grab_tasks,
+                                           return_exceptions=True)
         recs_written = []
-        for task in done:
-            try:
-                recs_written.append(task.result())
-            except Exception as e:
-                print('During grab_scene(): {}'.format(repr(e)))
+        for result in results:
+            if isinstance(result, Exception):
+                print('During grab_scene(): {}'.format(repr(result)))
+            else:
+                recs_written.append(result)
         return recs_written
     
     def prep_scenes(self, *args):
@@ -93,27 +95,32 @@ class LandsatThumbnails(object):
         """
         if self.specs['endDate']:
             enddates = [self.specs['endDate']]
+            latest = dateutil.parser.parse(self.specs['endDate']).date()
         else:
-            enddates = [datetime.date.today().isoformat()]
-
-        while len(enddates) < self.specs['N_images']:
-            earlier = (dateutil.parser.parse(enddates[-1]) -
-                       datetime.timedelta(days=self.specs['skip_days']))
-            enddates.append(earlier.date().isoformat())
+            latest = datetime.date.today()
+            enddates = [latest.isoformat()]
 
+        # The end date is parsed once, and earlier dates stepped from it:
+        skip = datetime.timedelta(days=self.specs['skip_days'])
+        enddates += [(latest - n*skip).isoformat()
+                     for n in range(1, self.specs['N_images'])]
         return enddates
     
-    async def grab_scene(self, bbox, enddate):
+    async def grab_scene(self, bbox, enddate, session=None):
         """Retrieve and reprocess scene assets.
 
         Arguments:
             bbox: a shapely box
             enddate: an isoformat date
+            session: Optional aiohttp.ClientSession to share connections
+                across scenes
 
         Returns: dict record, including 'paths' to images
         """
-        path, record = await self._retrieve(bbox, enddate)
-        output_paths = self.color_process(path)
+        path, record = await self._retrieve(bbox, enddate, session)
+        loop = asyncio.get_running_loop()
+        output_paths = await loop.run_in_executor(
+            None, self.color_process, path)
         record.update({'paths': output_paths})
         return record
 
@@ -127,11 +134,15 @@ class LandsatThumbnails(object):
     def search_latlon_clean(self, *args, **kwargs):
         return 'For Landsat only the pull method is available.'
     
-    async def _retrieve(self, bbox, enddate):
+    async def _retrieve(self, bbox, enddate, session=None):
         """Pull image from the web app.
 
         Returns: path to image and scene record
         """
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self._retrieve(bbox, enddate, session)
+
         payload = {
             'lat': '{:.4f}'.format(bbox.centroid.y),
             'lon': '{:.4f}'.format(bbox.centroid.x),
@@ -145,33 +156,34 @@ class LandsatThumbnails(object):
         path = (self.specs['file_header'] +
                 ''.join(k+v for k,v in payload.items()) + '.tif')
                 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.app_url,
-                                   params=payload,
-                                   allow_redirects=True) as response:
-                record = await response.json(content_type=None)
-                img_url = record.pop('url')
-            async with session.get(img_url) as img_response:
-                bin_img = await img_response.read()
+        async with session.get(self.app_url,
+                               params=payload,
+                               allow_redirects=True) as response:
+            record = await response.json(content_type=None)
+            img_url = record.pop('url')
+        async with session.get(img_url) as img_response:
+            bin_img = await img_response.read()
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._save, bin_img, path)
+        return path, record
 
+    def _save(self, bin_img, path):
+        """Decode and write an image to path."""
+        # Imported here, as only pulls need skimage:
+        import skimage.io
         # Save via skimage to get a 3-band PNG
         img = skimage.io.imread(io.BytesIO(bin_img))
         skimage.io.imsave(path, img)
 
-        return path, record
-
     def color_process(self, path):
         """Correct color, producing mutliple versions of the image.
 
         Returns: Paths to color-corrected images.
         """
-        output_paths = []
         styles = [style.lower() for style in self.specs['write_styles']
                   if style in color.STYLES]
-
-        for style in styles:
-            outpath = color.ColorCorrect(style=style)(path)
-            output_paths.append(outpath)
+        output_paths = color.correct_styles(path, styles)
 
         if self.specs['thumbnails']:
             os.remove(path)
@@ -44,6 +44,7 @@ specs take form:
     "landcover_indices": [],
     "thumbnails": false,
     "file_header": "",
+    "cache_downloads": false,  # keep raw downloads to reuse on later pulls
     "item_types": [
         "PSScene3Band",
 	    "PSOrthoTile",
@@ -55,11 +56,18 @@ specs take form:
 """
 
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import os
+import random
+import time
+from types import MappingProxyType
 
-import dateutil
 import numpy as np
 from planet import api
+from requests.adapters import HTTPAdapter
 import shapely
+from urllib3.util.retry import Retry
 
 from grabbers import base
 from postprocessing import gdal_routines
@@ -68,11 +76,43 @@ KNOWN_ITEM_TYPES = ['PSScene4Band', 'PSScene3Band', 'PSOrthoTile',
                     'REOrthoTile', 'SkySatScene']
 KNOWN_ASSET_TYPES = ['analytic', 'ortho_visual', 'visual']
 
-# For asynchronous handling of scene activation and download, in seconds:
-WAITTIME = 10
+# Preference among item types covering the same imagery, lower first:
+ITEM_TYPE_RANK = MappingProxyType(
+    {item_type: n for n, item_type in enumerate(KNOWN_ITEM_TYPES)})
+
+# Activation polls back off exponentially, with jitter, between these
+# intervals in seconds:
+MIN_WAITTIME = 1
+MAX_WAITTIME = 30
+# Activation is abandoned after this long, in seconds:
+MAX_ACTIVATION_TIME = 3600
+
+# Largest page of search results the Planet API will return:
+MAX_PAGE_SIZE = 250
+
+# Asset and activation requests are spaced to stay within Planet's rate
+# limits, in requests per second:
+ACTIVATION_RATE = 5
+
+# Asset and activation requests run on these threads, apart from the
+# default executor that downloads and reprocessing keep busy:
+API_WORKERS = 4
+api_executor = ThreadPoolExecutor(max_workers=API_WORKERS)
+
+# Cap on asset downloads streaming at once, across all scenes:
+MAX_CONCURRENT_WRITES = 8
+
+# Kept-alive connections held open to Planet, and retries of idempotent
+# requests on transient errors, with backoff in seconds:
+POOL_MAXSIZE = 32
+RETRIES = Retry(total=3, backoff_factor=0.5, raise_on_status=False,
+                status_forcelist=[429, 500, 502, 503, 504])
+
+# Downloads stream in small chunks; buffer them into large writes, in bytes:
+WRITE_BUFFER_SIZE = 1 << 20
 
 # Planet band numbers for R-G-B-NIR bands:
-BANDMAP = {   
+BANDMAP = MappingProxyType({
     'PSScene3Band': {
         'visual': [1, 2, 3],
         'analytic': [1, 2, 3]
@@ -92,10 +132,10 @@ BANDMAP = {
         'ortho_visual': [3, 2, 1],
         'analytic': [3, 2, 1, 4]
     }
-}
+})
 
 # To standardize image records:
-KEYMAP = {  
+KEYMAP = MappingProxyType({
     'provider': 'provider',
     'item_type': 'item_type',
     'asset_type': 'asset_type',
@@ -105,7 +145,67 @@ KEYMAP = {
     'gsd': 'gsd',
     'epsg_code': 'epsg_code',
     'satellite_id': 'satellite_id'
-}
+})
+
+
+@lru_cache(maxsize=None)
+def shared_client():
+    """Return a Planet client shared by all grabbers in this process.
+
+    Reusing one client keeps its HTTP session, and so its pool of open
+    connections, alive across searches, activation polls and downloads.
+    The session's pool is sized for concurrent downloads, and transient
+    errors on idempotent requests are retried.
+    """
+    client = api.ClientV1()
+    session = getattr(client.dispatcher, 'session', None)
+    if session is not None:
+        adapter = HTTPAdapter(pool_maxsize=POOL_MAXSIZE, max_retries=RETRIES)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return client
+
+@lru_cache(maxsize=None)
+def _asset_bandmap(asset_type):
+    """Map item types to their band numbers for asset_type."""
+    return MappingProxyType({k:v.get(asset_type) for k,v in BANDMAP.items()})
+
+@lru_cache(maxsize=64)
+def _cached_search_filters(clouds, startDate, endDate):
+    """Build catalog search filters, shared by grabbers with equal specs.
+
+    Returns: Tuple of filters, which must not be mutated.
+    """
+    sf = [api.filters.range_filter('cloud_cover', lt=clouds/100)]
+    if startDate:
+        sf.append(api.filters.date_range('acquired', gt=startDate))
+    if endDate:
+        sf.append(api.filters.date_range('acquired', lt=endDate))
+    return tuple(sf)
+
+class RateLimiter(object):
+    """Space out requests to keep within a rate limit.
+
+    Attributes:
+        interval: Minimum seconds between requests
+    
+    External method:
+        async acquire: Wait for the next available request slot.
+    """
+    def __init__(self, rate):
+        self.interval = 1/rate
+        self._next_slot = 0
+
+    async def acquire(self):
+        """Wait for the next available request slot."""
+        now = time.monotonic()
+        wait = self._next_slot - now
+        self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+# Shared by all grabbers, since Planet rate limits apply per API key:
+activation_limiter = RateLimiter(ACTIVATION_RATE)
 
 
 class PlanetGrabber(base.ImageGrabber):
@@ -113,18 +213,18 @@ class PlanetGrabber(base.ImageGrabber):
 
     External attributes and methods are defined in the parent ImageGrabber. 
     """
+    download_limit = MAX_CONCURRENT_WRITES
     
     def __init__(self, client=None, **kwargs):
         if not client:
-            client = api.ClientV1()
+            client = shared_client()
         super().__init__(client, **kwargs)
         if self.specs['landcover_indices']:
             self._tweak_landcover_specs()
         self._validate_asset_type()
-        self._bandmap = {k:v.get(self.specs['asset_type'])
-                             for k,v in BANDMAP.items()}
-        self._keymap = KEYMAP.copy()
+        self._bandmap = _asset_bandmap(self.specs['asset_type'])
         self._search_filters = self._build_search_filters()
+        self._search_request = self._build_search_request()
 
     # Initializations to Planet requirements
 
@@ -132,9 +232,9 @@ class PlanetGrabber(base.ImageGrabber):
         """Adjust item and asset types as required for landcover indices."""
         if 'PSScene3Band' in self.specs['item_types']:
             print('Replacing PSScene3Band with 4Band for landcover indices.')
-            self.specs['item_types'].remove('PSScene3Band')
-            self.specs['item_types'].append('PSScene4Band')
-            self.specs['item_types'] = list(set(self.specs['item_types']))
+            item_types = [t for t in self.specs['item_types']
+                          if t != 'PSScene3Band']
+            self.specs['item_types'] = list(set(item_types + ['PSScene4Band']))
         if self.specs['asset_type'] != 'analytic':
             print('Changing asset type to analytic, as required for landcover'
                   ' indices.')
@@ -152,31 +252,36 @@ class PlanetGrabber(base.ImageGrabber):
 
     def _build_search_filters(self):
         """Build filters to search catalog."""
-        sf = [api.filters.range_filter('cloud_cover',
-                                       lt=self.specs['clouds']/100)]
-        if self.specs['startDate']:
-            sf.append(api.filters.date_range('acquired',
-                                             gt=self.specs['startDate']))
-        if self.specs['endDate']:
-            sf.append(api.filters.date_range('acquired',
-                                             lt=self.specs['endDate']))
-        return sf
+        return _cached_search_filters(
+            self.specs['clouds'], self.specs['startDate'], self.specs['endDate'])
+
+    def _build_search_request(self):
+        """Build the bbox-independent part of a catalog search request."""
+        query = api.filters.and_filter(*self._search_filters)
+        return api.filters.build_search_request(query,
+            item_types=self.specs['item_types'])
                     
             
     # Search and scene preparation.
 
-    def _search(self, bbox):
+    def _search(self, bbox, max_records=None):
         """Search the catalog for relevant imagery.
 
+        Argument max_records: Optional limit on the number of records, which
+            also sizes the result pages fetched
+
         Returns: An iterator over image records. 
         """
         aoi = shapely.geometry.mapping(bbox)
-        query = api.filters.and_filter(
-            api.filters.geom_filter(aoi), *self._search_filters)
-        request = api.filters.build_search_request(query,
-            item_types=self.specs['item_types'])
-        response = self.client.quick_search(request, sort='acquired desc')
-        return response.items_iter(limit=None)
+        request = dict(self._search_request)
+        # and_filter holds its predicates in a tuple, with the geometry first:
+        request['filter'] = dict(request['filter'], config=(
+            (api.filters.geom_filter(aoi),) +
+            tuple(request['filter']['config'])))
+        page_size = min(max_records, MAX_PAGE_SIZE) if max_records else None
+        response = self.client.quick_search(
+            request, page_size=page_size, sort='acquired desc')
+        return response.items_iter(limit=max_records)
 
     def _search_id(self, catalogID, item_type):
         """Retrieve record for input catalogID."""
@@ -185,11 +290,13 @@ class PlanetGrabber(base.ImageGrabber):
 
     def _clean(self, record):
         """Streamline image record."""
-        cleaned = {'catalogID': record['id']}
-        cleaned.update({'thumbnail': record['_links']['thumbnail']})
-        cleaned.update({'full_record': record['_links']['_self']})
-        cleaned.update({self._keymap[k]:v for k,v
-            in record['properties'].items() if k in self._keymap})
+        properties = record['properties']
+        cleaned = {
+            'catalogID': record['id'],
+            'thumbnail': record['_links']['thumbnail'],
+            'full_record': record['_links']['_self'],
+            **{v:properties[k] for k,v in KEYMAP.items() if k in properties}
+        }
         cleaned['clouds'] *= 100
         return cleaned
 
@@ -211,30 +318,26 @@ class PlanetGrabber(base.ImageGrabber):
                 scenes = scenes[:self.specs['N_images']]
         return scenes
 
-    def _group_day(self, records, base):
+    def _group_day(self, records, base_record):
         """Collect a day's records, organized by satellite id and item type.
 
         Arguments:
-            base: The first record from a day
+            base_record: The first record from a day
             records:  Image record iterator
 
         Returns: A dict of records for the day and a new base record
         """
-        item_type = base['properties']['item_type']
-        sat_id = base['properties']['satellite_id']
-        date_0 = dateutil.parser.parse(base['properties']['acquired']).date()
+        item_type = base_record['properties']['item_type']
+        sat_id = base_record['properties']['satellite_id']
+        date_0 = self._date(base_record)
 
-        groups = {(sat_id, item_type): [base]}
+        groups = {(sat_id, item_type): [base_record]}
         for record in records:
-            date = dateutil.parser.parse(
-                record['properties']['acquired']).date()
+            date = self._date(record)
             if date == date_0:
                 item_type = record['properties']['item_type']
                 sat_id = record['properties']['satellite_id']
-                try: 
-                    groups[(sat_id, item_type)].append(record)
-                except KeyError:
-                    groups.update({(sat_id, item_type): [record]})
+                groups.setdefault((sat_id, item_type), []).append(record)
             else:
                 if self.specs.get('skip_days'):
                     if (date_0 - date).days < self.specs['skip_days']:
@@ -246,13 +349,18 @@ class PlanetGrabber(base.ImageGrabber):
 
     def _read_footprint(self, record):
         """Extract footprint in record as a shapely shape."""
-        return shapely.geometry.asShape(record['geometry'])
+        return shapely.geometry.shape(record['geometry'])
+
+    def _read_timestamp(self, record):
+        """Extract acquisition timestamp from record."""
+        return record['properties']['acquired']
 
     def _filter_by_overlap(self, bbox, groups):
         """Exclude groups that don't overlap sufficiently with bbox."""
         filtered = {}
         for key, records in groups.items():
-            _, frac_area = self._get_overlap(bbox, *records)
+            _, frac_area = self._get_overlap(
+                bbox, *records, min_frac=self.specs['min_intersect'])
             if self._well_overlapped(frac_area, *[r['id'] for r in records]):
                 filtered.update({key: records})
         return filtered
@@ -268,13 +376,13 @@ class PlanetGrabber(base.ImageGrabber):
         Returns: List of scenes (each scene a list of records)
         """
         filtered = {}
-        sat_ids = set([sat_id for (sat_id, _) in groups])
-        for sat_id in sat_ids:
-            for item_type in KNOWN_ITEM_TYPES:
-                if (sat_id, item_type) in groups:
-                    filtered[sat_id] = groups[(sat_id, item_type)]
-                    break
-        return list(filtered.values())
+        for (sat_id, item_type), records in groups.items():
+            rank = ITEM_TYPE_RANK.get(item_type)
+            if rank is None:
+                continue
+            if sat_id not in filtered or rank < filtered[sat_id][0]:
+                filtered[sat_id] = (rank, records)
+        return [records for _, records in filtered.values()]
 
     
     # Scene activation and download
@@ -284,48 +392,109 @@ class PlanetGrabber(base.ImageGrabber):
 
         Returns: List of paths to downloaded raw images.
         """
-        activation_tasks = [
-            self._activate(record['properties']['item_type'], record['id'])
+        download_tasks = [
+            self._activate_and_write(
+                record['properties']['item_type'], record['id'])
                 for record in scene
         ]
-        results = await asyncio.gather(*activation_tasks)
-        paths = [self._write(*result) for result in results]
+        paths = await asyncio.gather(*download_tasks)
         return paths
+
+    async def _activate_and_write(self, item_type, catalogID):
+        """Activate an asset and write it to disk as soon as it is ready.
+
+        The blocking write runs in a worker thread, so assets stream
+        concurrently, up to MAX_CONCURRENT_WRITES at a time.
+
+        Returns: Path to the downloaded raw image.
+        """
+        asset, catalogID = await self._activate(item_type, catalogID)
+        loop = asyncio.get_running_loop()
+        async with self._download_slot():
+            path = await loop.run_in_executor(
+                None, self._write, asset, catalogID)
+        return path
     
     async def _activate(self, item_type, catalogID):
         """Initiate and monitor asset activation.
 
-        Raises: KeyError when requested asset type isn't available
+        Blocking API calls run on api_executor threads, so the activations
+        of a scene's assets proceed concurrently, and are not held up
+        behind downloads and reprocessing in the default executor.
+
+        Raises: 
+            KeyError when requested asset type isn't available
+            TimeoutError if the asset is not active by MAX_ACTIVATION_TIME
 
         Returns: Activated asset and its catalogID 
             (so that ID tracks with asset during async processing)
         """
-        assets = self.client.get_assets_by_id(item_type, catalogID).get()
+        loop = asyncio.get_running_loop()
+        await activation_limiter.acquire()
+        assets = await loop.run_in_executor(
+            api_executor, self._get_assets, item_type, catalogID)
         try: 
             asset = assets[self.specs['asset_type']]
         except KeyError:
             raise KeyError('Asset type <{}> not available for ID {}.'.format(
                 self.specs['asset_type'], catalogID))
-        
-        self.client.activate(asset)
+        if self._is_active(asset):
+            return asset, catalogID
+
+        await activation_limiter.acquire()
+        await loop.run_in_executor(api_executor, self.client.activate, asset)
         print('Activating {}. '.format(catalogID) +
             'This could take several minutes.', flush=True)
+        waittime = MIN_WAITTIME
+        deadline = time.monotonic() + MAX_ACTIVATION_TIME
         while not self._is_active(asset):
-            await asyncio.sleep(WAITTIME)
-            assets = self.client.get_assets_by_id(item_type, catalogID).get()
+            if time.monotonic() > deadline:
+                raise TimeoutError('Activation of {} timed out.'.format(
+                    catalogID))
+            await asyncio.sleep(waittime * random.uniform(.8, 1.2))
+            waittime = min(2 * waittime, MAX_WAITTIME)
+            await activation_limiter.acquire()
+            try:
+                assets = await loop.run_in_executor(
+                    api_executor, self._get_assets, item_type, catalogID)
+            except api.exceptions.TooManyRequests:
+                continue
             asset = assets[self.specs['asset_type']]
         return asset, catalogID
 
+    def _get_assets(self, item_type, catalogID):
+        """Retrieve the assets available for catalogID."""
+        return self.client.get_assets_by_id(item_type, catalogID).get()
+
     def _is_active(self, asset):
         """Check asset activation status."""
-        return True if asset['status'] == 'active' else False
+        return asset['status'] == 'active'
             
     def _write(self, asset, catalogID):
-        """Call for the image data and write to disk."""
-        body = self.client.download(asset).get_body()
+        """Call for the image data and write to disk.
+
+        With cache_downloads set, a download kept from an earlier pull is
+        reused if its size matches the advertised content length.
+        """
         path = self._build_filename(catalogID)
+        reusable = self.specs['cache_downloads'] and os.path.exists(path)
+        body = self.client.download(asset).get_body()
+        if reusable and body.size and os.path.getsize(path) == body.size:
+            print('Reusing staged {}\n'.format(path), flush=True)
+            response = getattr(body, 'response', None)
+            if response is not None:
+                response.close()
+            return path
         print('Staging at {}\n'.format(path), flush=True)
-        body.write(file=path)
+        partial = path + '.part'
+        try:
+            with open(partial, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                body.write(file=f)
+        except Exception:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, path)
         return path
 
     def _build_filename(self, catalogID):
@@ -343,57 +512,40 @@ class PlanetGrabber(base.ImageGrabber):
         Returns: Scene image path and cleaned, combined record.
         """
         paths = self._reorder(paths, records)
-        central_record = next(iter(self._sort_by_overlap(bbox, records)))
-                                  
-        target_epsg_code = self._get_epsg_code(central_record)
-        if target_epsg_code:
-            paths = self._reproject(paths, records, target_epsg_code)
-
+        clean = not self.specs['cache_downloads']
+        central_record = self._max_overlap(bbox, records)
         overlap, _ = self._get_overlap(bbox, *records)
         bands = self._bandmap[central_record['properties']['item_type']]
         if not self.specs['landcover_indices']:
             bands = bands[:3]
-        paths = [gdal_routines.crop_and_reband(path, overlap, bands) 
-                     for path in paths]
-
         if len(paths) > 1:
-            scene_path = gdal_routines.merge(paths)
+            # Images are reprojected to the central image's projection
+            # within the merging warp:
+            scene_path = gdal_routines.crop_reband_and_merge(
+                paths, overlap, bands, clean=clean,
+                epsg_code=self._get_epsg_code(central_record))
         else:
-            scene_path = next(iter(paths))
+            scene_path = gdal_routines.crop_and_reband(
+                next(iter(paths)), overlap, bands, clean=clean)
         scene_record = {'component_images': [self._clean(r) for r in records]}
         return scene_path, scene_record
 
     def _reorder(self, paths, records):
         """After async download, order paths to match order of their records."""
+        paths = list(paths)
+        # Downloads are gathered in record order, so check that first:
+        if len(paths) == len(records) and all(
+                r['id'] in path for r, path in zip(records, paths)):
+            return paths
         ordered = []
         for r in records:
             ordered.append(next(path for path in paths if r['id'] in path))
         return ordered
         
-    def _sort_by_overlap(self, bbox, records):
-        """Sort records in group by overlap with bbox (large to small)."""
-        recs_sorted = sorted(
-            records, key=lambda rec: self._get_overlap(bbox, rec)[1],
-            reverse=True)
-        return recs_sorted
+    def _max_overlap(self, bbox, records):
+        """Find the record in group with largest overlap with bbox."""
+        return max(records, key=lambda rec: self._get_overlap(bbox, rec)[1])
 
     def _get_epsg_code(self, record):
         """Extract an EPSG code if available."""
         return record['properties'].get('epsg_code', None)
-
-    def _reproject(self, paths, records, target_epsg_code):
-        """As required, reproject images to target_epsg_code."""
-        reprojected = []
-        for path, record in zip(paths, records):
-            source_code = self._get_epsg_code(record)
-            if source_code and source_code != target_epsg_code:
-                path = gdal_routines.reproject(path, target_epsg_code)
-            reprojected.append(path)
-        return reprojected
-
-
-
-
-
-
-
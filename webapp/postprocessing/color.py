@@ -1,6 +1,9 @@
 """Functions for automated color correction on an image.
 
 Class ColorCorrect:  Perform basic color correction on an image.
+Function correct_styles:  Produce several styles of an image concurrently.
+Function nonzero_percentiles:  Find percentiles of nonzero pixel values.
+Function percentile_stride:  Find the sampling stride for float percentiles.
 
 Usage with predefined style 'base': 
 > cc = ColorCorrect(style='base')
@@ -51,14 +54,14 @@ Color tuning operations include:
 - Saturation adjustment
 
 """
-import copy
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 import os
 import subprocess
 import sys
 
 import numpy as np
 import rasterio
-from skimage import exposure
 
 # Parameters that apply no correction:
 NULL_PARAMS = {
@@ -77,6 +80,28 @@ COARSE_PARAMS = {
     'atmos_cut_fracs': {'green': .3, 'blue': .45}
 }
 
+# Maximum pixel values for standard images of each dtype:
+DTYPE_MAX = {
+    np.dtype('uint16'): 65535,
+    np.dtype('uint8'): 255,
+    np.dtype('float32'): 1.0
+}
+
+# Pixels counted per np.bincount call when building histograms:
+HISTOGRAM_CHUNK = 1 << 22
+
+# Float images larger than twice this many pixels are sampled down to
+# about this many for percentile estimates:
+PERCENTILE_SAMPLE_SIZE = 2000000
+
+# Per-band work runs on these threads; numpy's partition and take release
+# the GIL, so bands proceed in parallel. Shared by all ColorCorrect instances,
+# and sized to the R-G-B bands since callers already run styles and scenes
+# concurrently:
+BAND_WORKERS = 3
+band_executor = ThreadPoolExecutor(
+    max_workers=min(BAND_WORKERS, os.cpu_count() or 1))
+
 # Predefined styles:
 STYLES = {
     'base': {
@@ -112,6 +137,8 @@ class ColorCorrect(object):
     Attributes:
         cores: Integer number of processor cores to use, or -1 for all.  
         style: One of the predefined style above or 'custom'
+        bands: Optional list of R-G-B band numbers (indexed from 1) to read
+            from a multi-band image; if None, all bands are read.
         **params: Optional override params.
         
     External methods:
@@ -119,50 +146,92 @@ class ColorCorrect(object):
         coarse_adjust: Produce an image from raw analytic satellite data.
         tune: Tune colors.
     """
-    def __init__(self, cores=-1, style='custom', **params):
+    def __init__(self, cores=-1, style='custom', bands=None, **params):
         self.cores = cores
         self.style = style
-        self.params = copy.deepcopy(STYLES.get(style, NULL_PARAMS))
-        self.params.update(**params)
+        self.bands = bands
+        # Overrides layer over the shared style params, which are read-only:
+        self.params = ChainMap(params, STYLES.get(style, NULL_PARAMS))
 
-    def __call__(self, path):
-        """Run coarse and fine-tune color correction."""
-        if self._check_coarse():
-            coarsed = self.coarse_adjust(path)
-            tuned = self.tune(coarsed)
-            os.remove(coarsed)
+    def __call__(self, path, raster=None):
+        """Run coarse and fine-tune color correction.
+
+        Argument raster: Optional (image, profile) already read from path
+        """
+        if self._check_coarse() or self.bands:
+            # Intermediate is named by style so that styles can be run
+            # concurrently on the same path.
+            prefix = path.split('.tif')[0]
+            coarsed = self.coarse_adjust(
+                path, outpath=prefix + self.style + 'coarse.tif',
+                raster=raster)
+            tuned = self.tune(coarsed, outpath=self._tuned_name(path))
+            if coarsed != path:
+                os.remove(coarsed)
         else:
             tuned = self.tune(path)
         return tuned
 
+    def _coarse_key(self):
+        """Key the parameters that determine the coarse-adjusted image.
+
+        Returns: A hashable key, or None if no coarse adjustment is needed.
+        """
+        if self._check_coarse():
+            return (tuple(self.params['percentiles']), self.params['cut_frac'],
+                    tuple(sorted(self.params['atmos_cut_fracs'].items())),
+                    tuple(self.bands or ()))
+        if self.bands:
+            # Only the R-G-B bands are selected:
+            return (tuple(self.bands),)
+        return None
+
+    def _tuned_name(self, path):
+        """Name the tuned image as for path, coarse adjusted or not."""
+        prefix = path.split('.tif')[0]
+        if self._check_coarse():
+            return prefix + 'vis' + self.style + '.tif'
+        return prefix + self.style + '.tif'
+
     def _check_coarse(self):
         """Check for affirmative coarse correction parameters."""
         cut_fracs = [self.params.get('cut_frac'),
                      *(self.params.get('atmos_cut_fracs', {}).values())]
         return any(cut_fracs)
 
-    def coarse_adjust(self, path):
-        """Produce an image from raw analytic satellite data."""
-        with rasterio.open(path) as f:
-            profile = f.profile.copy()
-            img = f.read()
+    def coarse_adjust(self, path, outpath=None, raster=None):
+        """Produce an image from raw analytic satellite data.
+
+        Without coarse parameters, the bands are only selected.
+
+        Argument raster: Optional (image, profile) already read from path
+        """
+        if raster is None:
+            raster = _read_raster(path, bands=self.bands)
+        img, profile = raster[0], raster[1].copy()
         if not img.any():
             print('Warning: Image {} has all null values.'.format(path))
             return path
         
-        img = self._expand_histogram(img)
-        img = self._balance_colors(img)
-        img = self._remove_atmos(img)
+        if self._check_coarse():
+            if img.dtype in (np.uint8, np.uint16):
+                img = self._coarse_lookup(img)
+            else:
+                img = self._expand_histogram(img)
+                img = self._balance_colors(img)
+                img = self._remove_atmos(img)
 
-        profile.update({'photometric': 'RGB'})
-        outpath = path.split('.tif')[0] + 'vis.tif'
+        profile.update({'count': len(img), 'photometric': 'RGB'})
+        if not outpath:
+            outpath = path.split('.tif')[0] + 'vis.tif'
         with rasterio.open(outpath, 'w', **profile) as f:
             f.write(img) 
         return outpath
 
-    def tune(self, path):
+    def tune(self, path, outpath=None):
         """Tune colors."""
-        outpath = path.split('.tif')[0] + self.style + '.tif'
+        if not outpath:
+            outpath = path.split('.tif')[0] + self.style + '.tif'
         commands = [
             'rio', 'color', '-j', str(self.cores), '--co', 'photometric=RGB',
             path, outpath,
@@ -176,46 +245,85 @@ class ColorCorrect(object):
     
     def _expand_histogram(self, img):
         """Linearly rescale histogram."""
-        lowcut, highcut = np.percentile(img[np.where(img > 0)],
-                                        self.params['percentiles'])
+        lowcut, highcut = nonzero_percentiles(img, self.params['percentiles'])
         highcut = self._renorm_highcut(highcut, img.dtype)
         lowcut = self._renorm_lowcut(lowcut)
-        expanded = exposure.rescale_intensity(img, in_range=(lowcut, highcut))
+        expanded = _rescale_bands(img, [lowcut]*len(img), [highcut]*len(img),
+                                  self._get_max(img.dtype))
         return expanded
 
     def _balance_colors(self, img):
         """Linearly rescale histogram for each color channel separately."""
-        balanced = np.zeros(img.shape, dtype=img.dtype)
-        for n, band in enumerate(img):
-            lowcut, highcut = np.percentile(band[np.where(band > 0)],
-                                            self.params['percentiles'])
-            highcut = self._renorm_highcut(highcut, img.dtype)
-            lowcut = self._renorm_lowcut(lowcut)
-            balanced[n] = exposure.rescale_intensity(
-                band, in_range=(lowcut, highcut))
-        return balanced
+        cuts = np.array(list(band_executor.map(
+            lambda band: nonzero_percentiles(band, self.params['percentiles']),
+            img)))
+        lowcuts = self._renorm_lowcut(cuts[:,0])
+        highcuts = self._renorm_highcut(cuts[:,1], img.dtype)
+        return _rescale_bands(img, lowcuts, highcuts, self._get_max(img.dtype))
 
     def _remove_atmos(self, img):
         """Shift blue and green dark points to compensate for atmospheric
             scattering.
         """
-        cleaned = img.copy()
+        cleaned = np.empty_like(img)
+        cleaned[0] = img[0]
         green, blue = img[1:3]
         
-        glowcut, _ = np.percentile(green[np.where(green > 0)],
-                                   self.params['percentiles'])
+        glowcut, _ = nonzero_percentiles(green, self.params['percentiles'])
         glowcut *= self.params['atmos_cut_fracs']['green']
-        blowcut, _ = np.percentile(blue[np.where(blue > 0)],
-                                   self.params['percentiles'])
+        blowcut, _ = nonzero_percentiles(blue, self.params['percentiles'])
         blowcut *= self.params['atmos_cut_fracs']['blue']
         
-        cleaned[1] = exposure.rescale_intensity(
-            green, in_range=(glowcut, self._get_max(img.dtype)))
-        cleaned[2] = exposure.rescale_intensity(
-            blue, in_range=(blowcut, self._get_max(img.dtype)))
+        img_max = self._get_max(img.dtype)
+        _rescale_bands(img[1:3], [glowcut, blowcut], [img_max, img_max],
+                       img_max, out=cleaned[1:3])
         
         return cleaned
 
+    def _coarse_lookup(self, img):
+        """Run the coarse adjustments on an integer image via lookup tables.
+
+        Each step is a pointwise function of pixel value within a band,
+        so for uint8 or uint16 images the three steps compose into one
+        table per band, with an entry for each possible value.
+        Their percentiles are found from band histograms carried through
+        the tables, and the image itself is passed over only once.
+        """
+        percentiles = self.params['percentiles']
+        img_max = self._get_max(img.dtype)
+        counts = list(band_executor.map(_value_counts, img))
+        identity = np.arange(img_max + 1, dtype=img.dtype).reshape(1, 1, -1)
+
+        # _expand_histogram:
+        lowcut, highcut = _histogram_percentiles(sum(counts), percentiles)
+        lut = _rescale_bands(identity, [self._renorm_lowcut(lowcut)],
+                             [self._renorm_highcut(highcut, img.dtype)],
+                             img_max)
+        luts = np.repeat(lut, len(img), axis=0)
+
+        # _balance_colors:
+        cuts = np.array([
+            _histogram_percentiles(_map_counts(c, lut), percentiles)
+            for c, lut in zip(counts, luts[:,0])])
+        luts = _rescale_bands(luts, self._renorm_lowcut(cuts[:,0]),
+                              self._renorm_highcut(cuts[:,1], img.dtype),
+                              img_max)
+
+        # _remove_atmos:
+        for n, color in ((1, 'green'), (2, 'blue')):
+            lowcut, _ = _histogram_percentiles(
+                _map_counts(counts[n], luts[n,0]), percentiles)
+            lowcut *= self.params['atmos_cut_fracs'][color]
+            luts[n] = _rescale_bands(luts[n:n+1], [lowcut], [img_max],
+                                     img_max)[0]
+
+        adjusted = np.empty_like(img)
+        # Mapped for its writes into adjusted, and to raise any errors:
+        list(band_executor.map(lambda lut, band, out:
+                               np.take(lut[0], band, out=out),
+                               luts, img, adjusted))
+        return adjusted
+
     def _renorm_lowcut(self, cut):
         """Shift cut toward zero."""
         return cut * self.params['cut_frac']
@@ -228,15 +336,198 @@ class ColorCorrect(object):
 
     def _get_max(self, datatype):
         """Determine the maximum allowed pixel value for standard image."""
-        if datatype == 'uint16':
-            img_max = 65535
-        elif datatype == 'uint8':
-            img_max = 255
-        elif datatype == 'float32':
-            img_max = 1.0
-        else:
+        try:
+            return DTYPE_MAX[np.dtype(datatype)]
+        except (KeyError, TypeError):
             raise TypeError('Expecting dtype uint16, uint8 or float32.')
-        return img_max
+
+def nonzero_percentiles(img, percentiles):
+    """Find percentiles of the nonzero pixel values of img.
+
+    For uint8 and uint16 images the percentiles are read off a histogram
+    in one pass, with no copy of the nonzero pixels and no partial sort.
+
+    Arguments:
+        img: Numpy array of pixel values
+        percentiles: Sequence of percentiles in [0, 100]
+
+    Returns: Numpy array of values at the percentiles
+    """
+    if img.dtype not in (np.uint8, np.uint16):
+        return _partition_percentiles(img, percentiles)
+    return _histogram_percentiles(_value_counts(img), percentiles)
+
+def percentile_stride(size):
+    """Find the stride at which float images are sampled for percentiles.
+
+    The stride depends only on the number of pixels, so percentiles
+    found for an image are reproducible.
+
+    Argument size: Number of pixels in the image or band
+
+    Returns: Integer stride, 1 for images that are not sampled
+    """
+    if size > 2*PERCENTILE_SAMPLE_SIZE:
+        return size // PERCENTILE_SAMPLE_SIZE
+    return 1
+
+def _partition_percentiles(img, percentiles):
+    """Find percentiles of the positive values of an image.
+
+    For a nonnegative image, zeros sort first, so the ranks of nonzero
+    values are offset by the number of zeros, and a single np.partition
+    of the image finds them without first compacting the nonzero values
+    into a masked copy. Images with NaN or negative values, which
+    np.partition sorts last and before the zeros, are compacted.
+    Large images are sampled on a regular stride, which moves the
+    coarse percentiles used here by far less than they are then cut.
+
+    Raises: ValueError if the image has no positive values
+    """
+    flat = img.ravel()[::percentile_stride(img.size)]
+    positive = np.count_nonzero(flat > 0)
+    if positive == 0:
+        raise ValueError('No positive pixel values to find percentiles of.')
+    zeros = flat.size - np.count_nonzero(flat)
+    if zeros + positive < flat.size:
+        flat, zeros = flat[flat > 0], 0
+    ranks = (zeros + np.asarray(percentiles, dtype=float) / 100 *
+             (positive - 1))
+    below, above = np.floor(ranks).astype(int), np.ceil(ranks).astype(int)
+    partitioned = np.partition(flat, np.union1d(below, above))
+    low, high = partitioned[below], partitioned[above]
+    return low + (high - low) * (ranks - below)
+
+def _value_counts(img):
+    """Count the pixels of each value in a uint8 or uint16 image.
+
+    np.bincount casts its input to intp, so the image is counted in
+    chunks to bound that temporary copy.
+
+    Returns: Numpy array of counts, of length 256 or 65536
+    """
+    flat = img.ravel()
+    minlength = np.iinfo(img.dtype).max + 1
+    counts = np.zeros(minlength, dtype=np.int64)
+    for start in range(0, flat.size, HISTOGRAM_CHUNK):
+        counts += np.bincount(flat[start:start+HISTOGRAM_CHUNK],
+                              minlength=minlength)
+    return counts
+
+def _histogram_percentiles(counts, percentiles):
+    """Find percentiles of nonzero values from a histogram.
+
+    The result matches np.percentile, with linear interpolation, on the
+    nonzero values counted.
+
+    Arguments:
+        counts: Numpy array of the number of pixels with each value
+        percentiles: Sequence of percentiles in [0, 100]
+
+    Returns: Numpy array of values at the percentiles
+
+    Raises: ValueError if no nonzero values are counted
+    """
+    counts = np.array(counts)
+    counts[0] = 0
+    cdf = np.cumsum(counts)
+    if cdf[-1] == 0:
+        raise ValueError('No nonzero pixel values to find percentiles of.')
+    ranks = np.asarray(percentiles, dtype=float) / 100 * (cdf[-1] - 1)
+    below = np.floor(ranks)
+    # Value at sorted position k is the first value whose cdf exceeds k:
+    low = np.searchsorted(cdf, below, side='right')
+    high = np.searchsorted(cdf, np.ceil(ranks), side='right')
+    return low + (high - low) * (ranks - below)
+
+def _map_counts(counts, lut):
+    """Find the histogram of an image after applying lut to its values."""
+    return np.bincount(lut, weights=counts, minlength=len(counts)).astype(int)
+
+def _rescale_bands(img, lowcuts, highcuts, img_max, out=None):
+    """Linearly stretch each band of img between its own cuts.
+
+    All bands are rescaled in one broadcast pass over a float32 buffer,
+    as skimage's rescale_intensity would, but without its float64 copies.
+
+    Arguments:
+        img: Array of shape (bands, rows, cols)
+        lowcuts, highcuts: Sequences of per-band values to map to 0, img_max
+        img_max: Maximum pixel value for the dtype of img
+        out: Optional array of the same shape and dtype as img, to be
+            written in place
+
+    Returns: Rescaled array of the same shape and dtype as img
+    """
+    lowcuts = np.asarray(lowcuts, dtype='float32').reshape(-1, 1, 1)
+    highcuts = np.asarray(highcuts, dtype='float32').reshape(-1, 1, 1)
+    scaled = img.astype('float32')
+    scaled -= lowcuts
+    scaled *= img_max / (highcuts - lowcuts)
+    np.clip(scaled, 0, img_max, out=scaled)
+    if out is not None:
+        np.copyto(out, scaled, casting='unsafe')
+        return out
+    # Float32 images are returned from the working buffer without a copy:
+    return scaled.astype(img.dtype, copy=False)
+
+def _read_raster(path, bands=None):
+    """Read an image and its profile.
+
+    Argument bands: Optional list of band numbers (indexed from 1)
+
+    Returns: A numpy array and a rasterio profile
+    """
+    with rasterio.open(path) as f:
+        return f.read(bands), f.profile.copy()
+
+def correct_styles(path, styles, **params):
+    """Produce color-corrected versions of an image in multiple styles.
+
+    Styles are processed concurrently. The work is done in numpy and in
+    rio color subprocesses, which largely run outside the GIL, so threads
+    suffice. The image is read once, and styles with the same coarse
+    parameters (e.g. 'base' and 'vibrant') share one coarse adjustment.
+
+    Arguments:
+        path: Path to a 3-band GeoTiff
+        styles: List of styles from STYLES
+        **params: Optional override params passed to each ColorCorrect
+
+    Returns: Paths to color-corrected images, in the order of styles.
+    """
+    if not styles:
+        return []
+    correctors = [ColorCorrect(style=style, **params) for style in styles]
+    leaders = {}
+    for cc in correctors:
+        leaders.setdefault(cc._coarse_key(), cc)
+    if any(key is not None for key in leaders):
+        raster = _read_raster(path, bands=params.get('bands'))
+    else:
+        raster = None
+    prefix = path.split('.tif')[0]
+
+    def coarse(key, cc):
+        if key is None:
+            return path
+        return cc.coarse_adjust(
+            path, outpath=prefix + cc.style + 'coarse.tif', raster=raster)
+
+    def tune(cc):
+        key = cc._coarse_key()
+        if key is None:
+            return cc.tune(path)
+        return cc.tune(coarsed[key], outpath=cc._tuned_name(path))
+
+    with ThreadPoolExecutor(max_workers=len(styles)) as executor:
+        coarsed = dict(zip(leaders, executor.map(coarse, leaders,
+                                                 leaders.values())))
+        output_paths = list(executor.map(tune, correctors))
+    for coarse_path in coarsed.values():
+        if coarse_path != path:
+            os.remove(coarse_path)
+    return output_paths
 
 if __name__ == '__main__':
     usage_msg = ('Usage: python color.py image.tif')
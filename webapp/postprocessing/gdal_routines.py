@@ -1,8 +1,12 @@
 
+import math
 import os
 import subprocess
 
 import numpy as np
+import rasterio
+import rasterio.crs
+import rasterio.warp
 
 from geobox import geobox
 
@@ -101,6 +105,138 @@ def merge(filenames, srcnodata=0, clean=True):
             os.remove(filename)
     return targetname
 
+# For multiple GeoTiffs, crop, reband and merge can likewise be combined:
+# band selection is expressed in VRTs, which gdal_translate writes without
+# touching pixels, and a single gdalwarp crops and merges them. Pixels are
+# then decoded and encoded once, instead of once per crop and again in merge.
+# The output grid is snapped to the pixel grid of an input in the target
+# projection, so that those inputs are cropped without resampling.
+
+def crop_reband_and_merge(filenames, bbox, output_bands, srcnodata=0,
+                          clean=True, epsg_code=None):
+    """Crop GeoTiffs to bounding box, select output_bands, and merge.
+
+    Arguments:
+        filenames: GeoTiff filenames
+        bbox: A shapely box.
+        output_bands: A list of bands by number (indexed from 1)
+        srcnodata: Nodata value of the input GeoTiffs (ref. merge, above)
+        clean: True/False to delete the input files. 
+        epsg_code: Optional integer EPSG code to reproject to in the same
+            pass; if None, the projection of the first GeoTiff is used.
+
+    Output: Writes a GeoTiff.
+
+    Returns: New GeoTiff filename (based on the first input GeoTiff name)
+
+    Raises: subprocess.CalledProcessError if a gdal call fails
+    """
+    dressed_bands = np.asarray([('-b', str(b)) for b in output_bands])
+    vrtnames, processes = [], []
+    try:
+        for filename in filenames:
+            vrtname = filename.split('.tif')[0] + '-reband.vrt'
+            commands = [
+                'gdal_translate',
+                '-of', 'VRT',
+                *dressed_bands.flatten(),
+                filename, vrtname
+            ]
+            # The VRTs are independent, so their subprocesses run
+            # concurrently:
+            processes.append((subprocess.Popen(commands), commands))
+            vrtnames.append(vrtname)
+        for process, commands in processes:
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode,
+                                                    commands)
+
+        tags = ('_bbox{:.4f}_{:.4f}_{:.4f}_{:.4f}'.format(*bbox.bounds))
+        targetname = filenames[0].split('.tif')[0] + tags + '-merged.tif'
+        commands = [
+            'gdalwarp',
+            '--config', 'GDAL_CACHEMAX', '1000', '-wm', '1000',
+            '-multi', '-wo', 'NUM_THREADS=ALL_CPUS',
+            *_output_grid(filenames, bbox, epsg_code),
+            '-r', 'bilinear',
+            '-srcnodata', str(srcnodata),
+            '-co', 'COMPRESS=LZW'
+        ]
+        if len(output_bands) == 3:
+            commands += ['-co', 'photometric=RGB']
+        commands += [*vrtnames, targetname]
+        try:
+            subprocess.check_call(commands)
+        except subprocess.CalledProcessError:
+            if os.path.exists(targetname):
+                os.remove(targetname)
+            raise
+    finally:
+        for process, _ in processes:
+            process.wait()
+        for vrtname in vrtnames:
+            if os.path.exists(vrtname):
+                os.remove(vrtname)
+
+    if clean:
+        for filename in filenames:
+            os.remove(filename)
+    return targetname
+
+def _output_grid(filenames, bbox, epsg_code=None):
+    """Find gdalwarp options for the output grid of a merge.
+
+    The extent of bbox is snapped outward to the pixel grid of the first
+    GeoTiff in the target projection, at its resolution, and GeoTiffs in
+    other projections are resampled onto that grid. If none is in the
+    target projection, the first GeoTiff's resolution is converted to
+    the target projection, so output size follows the source GSD
+    rather than an estimate from bbox.
+
+    Arguments:
+        filenames: GeoTiff filenames
+        bbox: A shapely box.
+        epsg_code: Optional integer EPSG code of the target projection; if
+            None, the projection of the first GeoTiff is used.
+
+    Returns: List of gdalwarp command line options
+    """
+    crss, transforms, shapes = [], [], []
+    for filename in filenames:
+        with rasterio.open(filename) as f:
+            crss.append(f.crs)
+            transforms.append(f.transform)
+            shapes.append((f.width, f.height, *f.bounds))
+    if epsg_code:
+        target_crs = rasterio.crs.CRS.from_epsg(epsg_code)
+        reproject = ['-t_srs', 'EPSG:'+str(epsg_code)]
+    else:
+        target_crs, reproject = crss[0], []
+    try:
+        transform = next(t for crs, t in zip(crss, transforms)
+                         if crs == target_crs)
+    except StopIteration:
+        # Resample at the first GeoTiff's resolution carried into the
+        # target projection, on a grid aligned to multiples of it:
+        transform, _, _ = rasterio.warp.calculate_default_transform(
+            crss[0], target_crs, *shapes[0])
+        return ['-te_srs', 'EPSG:4326', '-te',
+                *[str(b) for b in bbox.bounds],
+                '-tr', repr(transform.a), repr(-transform.e), '-tap',
+                *reproject]
+
+    xres, yres = transform.a, -transform.e
+    left, bottom, right, top = rasterio.warp.transform_bounds(
+        rasterio.crs.CRS.from_epsg(4326), target_crs, *bbox.bounds)
+    extent = [
+        transform.c + math.floor((left - transform.c)/xres)*xres,
+        transform.f - math.ceil((transform.f - bottom)/yres)*yres,
+        transform.c + math.ceil((right - transform.c)/xres)*xres,
+        transform.f - math.floor((transform.f - top)/yres)*yres
+    ]
+    return ['-te', *[repr(b) for b in extent],
+            '-tr', repr(xres), repr(yres), *reproject]
+
 # Separate crop and reband routines:
  
 def crop(filename, bbox, clean=True):
@@ -7,12 +7,22 @@ $ python landcover.py -h
 
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
 import sys
 
 import rasterio
 
 INDICES = ['ndvi', 'ndwi']
 
+# Indices are computed in worker processes shared by all calls. Workers
+# start from a forkserver rather than by forking the multithreaded caller,
+# whose GDAL and numpy locks a forked child could inherit held:
+index_executor = ProcessPoolExecutor(
+    max_workers=min(len(INDICES), os.cpu_count() or 1),
+    mp_context=multiprocessing.get_context('forkserver'))
+
 def compute_index(path, index):
     """Compute a landcover index on a four-band GeoTiff.
 
@@ -40,6 +50,27 @@ def compute_index(path, index):
         f.write(computed, 1)
     return outfile
 
+def compute_indices(path, indices):
+    """Compute several landcover indices in parallel worker processes.
+
+    Arguments: 
+        path: Path to a GeoTiff with bands ordered R-G-B-NIR
+        indices: List of INDICES
+    
+    Returns: List with, for each index in order, the path to a grayscale 
+        GeoTiff or the ValueError raised in computing it
+    """
+    if len(indices) < 2:
+        return [_try_index(path, index) for index in indices]
+    return list(index_executor.map(_try_index, [path]*len(indices), indices))
+
+def _try_index(path, index):
+    """Compute an index, returning rather than raising a ValueError."""
+    try:
+        return compute_index(path, index)
+    except ValueError as e:
+        return e
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Compute common remote sensing indices.'
@@ -1,8 +1,5 @@
 
-import numpy as np
-
 from PIL import Image
-import skimage.io
 
 def make_thumbnails(paths, max_dims=(512,512)):
     """Convert image to thumbnail.
@@ -19,7 +16,8 @@ def make_thumbnails(paths, max_dims=(512,512)):
             img = Image.open(path)
         except OSError:
             continue
+        # thumbnail() loads and resamples in place; Pillow then encodes
+        # directly, with no round trip through a numpy array.
         img.thumbnail(max_dims)
-        img = np.asarray(img)     # force the resampling now
-        skimage.io.imsave(path, img)
+        img.save(path)
     return
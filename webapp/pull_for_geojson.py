@@ -57,7 +57,7 @@ async def pull_for_feature(image_grabber, feature):
         feature.update({'properties': {}})
     if 'images' not in feature['properties']:
         feature['properties'].update({'images': []})
-    polygon = shapely.geometry.asShape(feature['geometry'])
+    polygon = shapely.geometry.shape(feature['geometry'])
     bbox = shapely.geometry.box(*polygon.bounds)
     records = await image_grabber.pull(bbox)
     feature['properties']['images'] += records
@@ -102,6 +102,7 @@ if __name__ == '__main__':
     features_filename = kwargs.pop('features_filename')
     kwargs = {k:v for k,v in kwargs.items() if v is not None}
     image_grabber = GRABBERS[provider](**kwargs)
+    base.use_uvloop()
     looped = base.loop(pull_for_geojson)
     outfile = looped(image_grabber, features_filename)
     print('Links to images are written in {}'.format(outfile))
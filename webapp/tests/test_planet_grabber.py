@@ -0,0 +1,62 @@
+"""Tests for the Planet catalog search request.
+
+Run from the webapp directory:
+$ python -m unittest tests.test_planet_grabber
+
+"""
+import unittest
+
+try:
+    from planet import api
+    import shapely.geometry
+
+    from grabbers import planet_grabber
+except ImportError:
+    planet_grabber = None
+
+class RecordingClient(object):
+    """Stand-in for the Planet client that keeps the search request."""
+    def quick_search(self, request, **kwargs):
+        self.request = request
+        return self
+
+    def items_iter(self, limit=None):
+        return iter([])
+
+@unittest.skipIf(planet_grabber is None, 'Planet grabber dependencies not '
+                 'importable.')
+class SearchRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grabber = object.__new__(planet_grabber.PlanetGrabber)
+        self.grabber.client = RecordingClient()
+        self.grabber.specs = {
+            'clouds': 10,
+            'startDate': '2008-09-01T00:00:00.0000Z',
+            'endDate': '2018-09-01T00:00:00.0000Z',
+            'item_types': ['PSScene3Band', 'PSOrthoTile']
+        }
+        self.grabber._search_filters = self.grabber._build_search_filters()
+        self.grabber._search_request = self.grabber._build_search_request()
+        self.bbox = shapely.geometry.box(-122.43, 37.76, -122.41, 37.78)
+
+    def test_search_matches_full_request(self):
+        """The spliced request equals one built whole with the bbox."""
+        list(self.grabber._search(self.bbox))
+        aoi = shapely.geometry.mapping(self.bbox)
+        query = api.filters.and_filter(
+            api.filters.geom_filter(aoi), *self.grabber._search_filters)
+        expected = api.filters.build_search_request(
+            query, item_types=self.grabber.specs['item_types'])
+        self.assertEqual(self.grabber.client.request, expected)
+
+    def test_search_leaves_prebuilt_request(self):
+        """Searching does not alter the request shared across searches."""
+        prebuilt = self.grabber._search_request
+        config = prebuilt['filter']['config']
+        list(self.grabber._search(self.bbox))
+        self.assertIs(self.grabber._search_request['filter']['config'], config)
+        self.assertEqual(len(config), len(self.grabber._search_filters))
+
+if __name__ == '__main__':
+    unittest.main()
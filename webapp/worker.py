@@ -5,6 +5,7 @@ from rq import Worker, Queue, Connection
 from rq.handlers import move_to_failed_queue
 
 from exception_handler import post_to_db
+from grabbers import base
 
 listen = ['default']
 
@@ -14,6 +15,7 @@ redis_url = os.getenv('REDISTOGO_URL', 'redis://redis_worker:6379')
 connection = redis.from_url(redis_url)
 
 if __name__ == '__main__':
+    base.use_uvloop()
     with Connection(connection):
         worker = Worker(
             map(Queue, listen),